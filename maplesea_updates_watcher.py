@@ -6,6 +6,8 @@ MapleSEA Updates Watcher
 - Supports per-webhook prefixes (e.g., <@USER_ID>, @everyone)
 - Detects title changes on the listing page as "updates"
 - Persists seen URLs and last known title in SQLite
+- Sends a conditional GET (ETag / Last-Modified) and skips parsing on 304;
+  skips the DB diff when the page body is byte-identical to the last one
 
 Config priority:
 1) config.json written by the workflow from GitHub Secrets:
@@ -15,32 +17,63 @@ Config priority:
    - DISCORD_WEBHOOK_URLS_CSV       (comma-separated URLs)
 """
 
-import os, sqlite3, re, json
+import os, sqlite3, json, atexit, functools, hashlib, contextlib, codecs, threading
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime, timezone
+from types import MappingProxyType
 from urllib.parse import urljoin
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from lxml import etree
 
 BASE_URL = "https://www.maplesea.com/updates"
-ALLOWED_HREF = re.compile(r"/updates(/|$)", re.IGNORECASE)
 DB_PATH = os.environ.get("DB_PATH", "seen_links.db")
 CONFIG_PATH = "config.json"
+# meta keys saved from the last processed page, used to skip unchanged ones
+PAGE_VALIDATORS = ("etag", "last_modified", "body_hash")
 
 HEADERS = {
     "User-Agent": "MapleSEA-Updates-Watcher/1.2 (+https://github.com/your/repo)"
 }
 TIMEOUT = 20
+MAX_WORKERS = 8  # concurrent webhook posts
+POST_WAIT_TIMEOUT = 60  # seconds main() waits before skipping unsent webhook posts
+
+# One keep-alive session for the scrape GET and all webhook POSTs, so each
+# host only pays for a TCP+TLS handshake once per run. Retry only covers
+# idempotent methods by default, so a failed POST never double-posts.
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+_adapter = HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 502, 503, 504]),
+)
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
+
+# Webhook posts run in the background so DB work overlaps with network I/O;
+# main() waits for them (up to POST_WAIT_TIMEOUT) before returning.
+EXEC = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="discord")
 
 # ---------- Config loading ----------
 
+@functools.lru_cache(maxsize=1)
 def load_config():
+    """
+    Read config once per process. Returns a read-only mapping whose
+    DISCORD_WEBHOOK_URLS is a tuple of read-only webhook entries.
+    """
     cfg = {}
-    if os.path.exists(CONFIG_PATH):
-        try:
-            with open(CONFIG_PATH, "r", encoding="utf-8") as f:
-                cfg = json.load(f)
-        except Exception as e:
-            print(f"WARNING: Could not read {CONFIG_PATH}: {e}")
+    try:
+        with open(CONFIG_PATH, "r", encoding="utf-8") as f:
+            cfg = json.load(f)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"WARNING: Could not read {CONFIG_PATH}: {e}")
 
     webhooks = cfg.get("DISCORD_WEBHOOK_URLS")
 
@@ -54,44 +87,134 @@ def load_config():
         if csv:
             webhooks = [{"url": u.strip(), "prefix": ""} for u in csv.split(",") if u.strip()]
 
-    cfg["DISCORD_WEBHOOK_URLS"] = webhooks or []
-    return cfg
+    cfg["DISCORD_WEBHOOK_URLS"] = tuple(
+        MappingProxyType(dict(w)) if isinstance(w, dict) else w for w in (webhooks or [])
+    )
+    return MappingProxyType(cfg)
 
 # ---------- DB helpers ----------
 
 def init_db():
-    """Create table if missing; add new columns if coming from older script."""
-    conn = sqlite3.connect(DB_PATH)
+    """Create tables if missing; migrate DBs from older script versions once."""
+    # Autocommit mode: transactions are only the explicit ones from transaction()
+    conn = sqlite3.connect(DB_PATH, isolation_level=None)
+    # WAL + NORMAL: one fsync per checkpoint instead of a journal pair per commit
+    mode = conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+    if mode.lower() != "wal":
+        print(f"WARNING: SQLite journal_mode is {mode!r}, expected 'wal'")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=134217728")
+    # Closing cleanly checkpoints the WAL back into DB_PATH, which is the only
+    # file the workflow caches between runs.
+    atexit.register(close_db, conn)
     conn.execute("""
         CREATE TABLE IF NOT EXISTS seen_links (
             url TEXT PRIMARY KEY,
             first_seen_utc TEXT NOT NULL,
             last_title TEXT,
-            last_changed_utc TEXT
+            last_changed_utc TEXT,
+            last_title_hash BLOB
         )
     """)
-    for coldef in ("last_title TEXT", "last_changed_utc TEXT"):
-        try:
-            conn.execute(f"ALTER TABLE seen_links ADD COLUMN {coldef}")
-        except Exception:
-            pass
-    conn.commit()
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    """)
+
+    # Migrations run once per DB; PRAGMA user_version records the last one applied.
+    # To add one, append an "if version < N:" block that ends by setting user_version=N.
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version < 1:
+        with transaction(conn):
+            for coldef in ("last_title TEXT", "last_changed_utc TEXT", "last_title_hash BLOB"):
+                try:
+                    conn.execute(f"ALTER TABLE seen_links ADD COLUMN {coldef}")
+                except Exception:
+                    pass
+            # Hash titles stored before last_title_hash existed
+            rows = conn.execute(
+                "SELECT url, last_title FROM seen_links WHERE last_title_hash IS NULL AND last_title <> ''"
+            ).fetchall()
+            if rows:
+                conn.executemany(
+                    "UPDATE seen_links SET last_title_hash=? WHERE url=?",
+                    [(title_hash(t), u) for (u, t) in rows],
+                )
+            # Covering index: diff_links() reads (url, last_title_hash) without touching table rows
+            conn.execute("DROP INDEX IF EXISTS idx_seen_url_title")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_seen_url_title_hash ON seen_links(url, last_title_hash)")
+            conn.execute("ANALYZE")
+            conn.execute("PRAGMA user_version=1")
     return conn
 
-def get_seen(conn):
-    return {row[0] for row in conn.execute("SELECT url FROM seen_links")}
+@contextlib.contextmanager
+def transaction(conn):
+    """BEGIN IMMEDIATE ... COMMIT around the block; ROLLBACK if it raises."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        # SQLite may already have rolled back itself (e.g. SQLITE_FULL); a second
+        # ROLLBACK would then raise and hide the original error
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+def close_db(conn):
+    try:
+        conn.execute("PRAGMA optimize")
+    except sqlite3.Error as e:
+        print(f"WARNING: PRAGMA optimize failed: {e}")
+    conn.close()
 
-def get_row(conn, url):
-    cur = conn.execute("SELECT url, last_title FROM seen_links WHERE url=?", (url,))
-    row = cur.fetchone()
-    if not row:
+def title_hash(title):
+    """8-byte digest of a listing title; None for a missing/empty title."""
+    if not title:
         return None
-    return {"url": row[0], "last_title": row[1]}
+    return hashlib.blake2b(title.encode("utf-8"), digest_size=8).digest()
+
+def get_meta(conn, key):
+    row = conn.execute("SELECT value FROM meta WHERE key=?", (key,)).fetchone()
+    return row[0] if row else None
+
+def set_meta(conn, key, value):
+    conn.execute("INSERT OR REPLACE INTO meta(key, value) VALUES(?,?)", (key, value))
+
+def diff_links(conn, items):
+    """
+    Classify scraped (url, title) pairs against one snapshot of seen_links.
+    Returns (new_items, changed, backfill), each a list of (url, title):
+    - new_items: URL never seen before
+    - changed:   seen before, listing title hash differs from the stored one
+    - backfill:  seen before, but no title stored (DB from earlier version)
+    """
+    state = dict(conn.execute("SELECT url, last_title_hash FROM seen_links"))
 
-def set_title(conn, url, title):
+    new_items, changed, backfill = [], [], []
+    for url, title in items:
+        if url not in state:
+            new_items.append((url, title))
+            continue
+        last_hash = state[url]
+        if last_hash is None:
+            backfill.append((url, title))
+        elif title_hash(title) != last_hash:
+            changed.append((url, title))
+    return new_items, changed, backfill
+
+def set_titles(conn, items):
+    """
+    items: list of (url, title)
+    """
     now = datetime.now(timezone.utc).isoformat()
-    conn.execute("UPDATE seen_links SET last_title=?, last_changed_utc=? WHERE url=?", (title, now, url))
-    conn.commit()
+    conn.executemany(
+        "UPDATE seen_links SET last_title=?, last_title_hash=?, last_changed_utc=? WHERE url=?",
+        [(t, title_hash(t), now, u) for (u, t) in items],
+    )
 
 def mark_seen(conn, items):
     """
@@ -99,105 +222,208 @@ def mark_seen(conn, items):
     """
     now = datetime.now(timezone.utc).isoformat()
     conn.executemany("""
-        INSERT OR IGNORE INTO seen_links(url, first_seen_utc, last_title, last_changed_utc)
-        VALUES(?,?,?,?)
-    """, [(u, now, t, None) for (u, t) in items])
-    conn.commit()
+        INSERT OR IGNORE INTO seen_links(url, first_seen_utc, last_title, last_changed_utc, last_title_hash)
+        VALUES(?,?,?,?,?)
+    """, [(u, now, t, None, title_hash(t)) for (u, t) in items])
 
 # ---------- Scrape + notify ----------
 
-def fetch_links():
-    r = requests.get(BASE_URL, headers=HEADERS, timeout=TIMEOUT)
+def parse_links(chunks, charset=None):
+    """
+    Incrementally parse the page (an iterable of raw byte chunks) and return the
+    unique (url, text) pairs of update links, in page order.
+    Once an <a> has been read, it and everything before it in the document
+    are dropped from the tree, so the parsed tree stays bounded by the markup
+    between two consecutive links rather than growing with the whole page.
+    """
+    # Decode with the charset from the HTTP Content-Type when there is one (as r.text
+    # did); otherwise lxml sniffs it from the page's <meta charset>
+    parser = etree.HTMLPullParser(events=("end",), tag="a", encoding=charset)
+    # De-duplicate by URL, keeping the first occurrence (dicts keep insertion order)
+    links = {}
+
+    def drain():
+        for _, a in parser.read_events():
+            href = (a.get("href") or "").strip()
+            # Update pages: "/updates" at the end or "/updates/" anywhere (any case)
+            lh = href.lower()
+            if lh.endswith("/updates") or "/updates/" in lh:
+                url = urljoin(BASE_URL, href)
+                if url not in links:
+                    # Built like BeautifulSoup's get_text(strip=True): stripped strings joined
+                    # with no separator, <script>/<style> text skipped. One known difference:
+                    # libxml2 ends an <a> at a nested <table>, so text from there on is lost.
+                    etree.strip_elements(a, "script", "style", with_tail=False)
+                    links[url] = " ".join("".join(s.strip() for s in a.itertext()).split())
+            a.clear()
+            # Delete the finished nodes before this anchor, at every level up to the root
+            node, parent = a, a.getparent()
+            while parent is not None:
+                while node.getprevious() is not None:
+                    del parent[0]
+                node, parent = parent, parent.getparent()
+
+    for chunk in chunks:
+        parser.feed(chunk)
+        drain()
+    parser.close()
+    drain()
+    return list(links.items())
+
+def fetch_links(validators):
+    """
+    Conditional GET using the validators saved by the previous run
+    (see PAGE_VALIDATORS). Returns (links, validators); links is None if
+    the page is unchanged: HTTP 304, or a body that hashes the same, in
+    which case the HTML parser is never run.
+    """
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    r = SESSION.get(BASE_URL, headers=headers, timeout=TIMEOUT)
+    if r.status_code == 304:
+        return None, validators
     r.raise_for_status()
-    soup = BeautifulSoup(r.text, "html.parser")
 
-    links = []
-    for a in soup.find_all("a", href=True):
-        href = a["href"].strip()
-        if not ALLOWED_HREF.search(href):
-            continue
-        url = urljoin(BASE_URL, href)
-        text = " ".join(a.get_text(strip=True).split())
-        links.append((url, text))
-
-    # De-duplicate by URL
-    seen_urls = set()
-    uniq = []
-    for url, text in links:
-        if url not in seen_urls:
-            seen_urls.add(url)
-            uniq.append((url, text))
-    return uniq
+    body = r.content  # one listing page: cheap to buffer, and lets a same-hash run skip the parse
+    current = {
+        "etag": r.headers.get("ETag"),
+        "last_modified": r.headers.get("Last-Modified"),
+        "body_hash": hashlib.blake2b(body, digest_size=8).hexdigest(),
+    }
+    if current["body_hash"] == validators.get("body_hash"):
+        return None, current
+
+    charset = None
+    if "charset=" in r.headers.get("Content-Type", "").lower():
+        charset = requests.utils.get_encoding_from_headers(r.headers)
+        try:
+            codecs.lookup(charset)
+        except LookupError:
+            charset = None  # unknown name: fall back to sniffing, like r.text did
+    chunk_size = 64 * 1024
+    chunks = (body[i:i + chunk_size] for i in range(0, len(body), chunk_size))
+    return parse_links(chunks, charset), current
 
 def send_to_webhook(webhook_url, message, url):
     payload = {"content": f"{message}\n{url}"}
     try:
-        resp = requests.post(webhook_url, json=payload, timeout=TIMEOUT)
+        resp = SESSION.post(webhook_url, json=payload, timeout=TIMEOUT)
         resp.raise_for_status()
     except Exception as e:
         print(f"ERROR sending to Discord ({webhook_url[:60]}...): {e}")
 
-def send_discord(webhooks, message, url):
+def send_discord(webhooks, notifications, stop):
     """
-    webhooks: list of {"url": str, "prefix": str}
+    webhooks: sequence of {"url": str, "prefix": str}
+    notifications: list of (message, url)
+
+    Queues one background job per webhook on EXEC and returns the futures.
+    Once `stop` (a threading.Event) is set, jobs send nothing further.
+    Webhooks are posted to concurrently; each one still receives its
+    messages in order, one at a time.
     """
+    if not notifications:
+        return []
     if not webhooks:
         print("⚠️  No Discord webhooks configured. Printing message instead:")
-        print(f"{message}\n{url}")
-        return
+        for message, url in notifications:
+            print(f"{message}\n{url}")
+        return []
+
+    targets = []
     for w in webhooks:
-        if isinstance(w, dict):
-            prefix = w.get("prefix", "")
-            u = w.get("url")
-            if u:
-                send_to_webhook(u, f"{prefix}{message}", url)
+        if isinstance(w, Mapping):
+            if w.get("url"):
+                targets.append((w["url"], w.get("prefix", "")))
         elif isinstance(w, str):
             # tolerate plain string entries
-            send_to_webhook(w, message, url)
+            targets.append((w, ""))
+
+    def post_all(webhook_url, prefix):
+        for message, url in notifications:
+            if stop.is_set():
+                return
+            send_to_webhook(webhook_url, f"{prefix}{message}", url)
+
+    return [EXEC.submit(post_all, webhook_url, prefix) for webhook_url, prefix in targets]
+
+def wait_for_posts(futures, stop, timeout=POST_WAIT_TIMEOUT):
+    """
+    Wait up to `timeout` seconds for queued webhook posts and log any job
+    that crashed. On timeout, set `stop` so the jobs send nothing more;
+    a POST already in flight still finishes (bounded by TIMEOUT).
+    """
+    done, not_done = wait(futures, timeout=timeout)
+    if not_done:
+        stop.set()
+        print(f"WARNING: Discord posts still pending after {timeout}s; "
+              f"skipping the rest for {len(not_done)} webhook(s)")
+    for f in done:
+        e = f.exception()
+        if e is not None:
+            print(f"ERROR sending to Discord: {e}")
 
 # ---------- Main ----------
 
 def main():
     cfg = load_config()
-    webhooks = cfg.get("DISCORD_WEBHOOK_URLS", [])
+    webhooks = cfg.get("DISCORD_WEBHOOK_URLS", ())
 
     conn = init_db()
-    previously_seen = get_seen(conn)
+    previous = {key: get_meta(conn, key) for key in PAGE_VALIDATORS}
 
     try:
-        items = fetch_links()  # list[(url, title)]
+        items, validators = fetch_links(previous)  # list[(url, title)]
     except Exception as e:
         print(f"ERROR fetching {BASE_URL}: {e}")
         return 1
 
-    # 1) New URLs
-    new_items = [(u, t) for (u, t) in items if u not in previously_seen]
-    if new_items:
-        for url, title in new_items:
-            send_discord(webhooks, f"🆕 NEW: **{title}**", url)
-        mark_seen(conn, new_items)
+    if items is None:
+        # Same body under a new ETag/Last-Modified: keep them for the next conditional GET
+        if validators != previous:
+            with transaction(conn):
+                for key, value in validators.items():
+                    set_meta(conn, key, value)
+        print(f"{datetime.now()}: Page unchanged. No new links. No title updates detected.")
+        return 0
 
-    # 2) Title updates on listing page
-    updated_count = 0
-    for url, title in items:
-        if url not in previously_seen:
-            continue
-        row = get_row(conn, url)
-        if not row:
-            continue
-        last_title = row["last_title"]
-        if not last_title:
-            # Backfill title (DB from earlier version)
-            set_title(conn, url, title)
-        elif title != last_title:
-            send_discord(webhooks, f"🔄 UPDATED (title changed): **{title}**", url)
-            set_title(conn, url, title)
-            updated_count += 1
-
-    if not new_items and updated_count == 0:
-        print(f"{datetime.now()}: No new links. No title updates detected.")
-    else:
-        print(f"{datetime.now()}: New links: {len(new_items)}, Title updates: {updated_count}.")
+    futures, stop = [], threading.Event()
+    try:
+        # All writes below go into one transaction (a single commit per run)
+        with transaction(conn):
+            new_items, changed, backfill = diff_links(conn, items)
+
+            notifications = []
+            for url, title in new_items:
+                notifications.append((f"🆕 NEW: **{title}**", url))
+            for url, title in changed:
+                notifications.append((f"🔄 UPDATED (title changed): **{title}**", url))
+            # Posts go out in the background while the writes below run
+            futures = send_discord(webhooks, notifications, stop)
+
+            # 1) New URLs
+            if new_items:
+                mark_seen(conn, new_items)
+
+            # 2) Title updates on listing page, plus backfills for rows from an earlier version
+            if changed or backfill:
+                set_titles(conn, changed + backfill)
+            updated_count = len(changed)
+
+            # Only remember the validators once this page has been fully processed
+            for key, value in validators.items():
+                set_meta(conn, key, value)
+
+        if not new_items and updated_count == 0:
+            print(f"{datetime.now()}: No new links. No title updates detected.")
+        else:
+            print(f"{datetime.now()}: New links: {len(new_items)}, Title updates: {updated_count}.")
+    finally:
+        # Also runs if a DB write fails after posts were queued
+        wait_for_posts(futures, stop)
     return 0
 
 if __name__ == "__main__":